@@ -1,3 +1,5 @@
+from typing import Union
+
 from qiskit import (
     IBMQ, QuantumCircuit, Aer, execute
 )
@@ -12,10 +14,15 @@ from qiskit.providers.aer.noise import NoiseModel
 
 class IBMQHandler:
 
-    def __init__(self, n_qubits: int, shots: int = 8192, credentials: str = ""):
+    def __init__(self, n_qubits: int, shots: int = 8192, credentials: str = "",
+                 max_circuits_per_job: int = None):
         self.n_qubits = n_qubits
         self.shots = shots
 
+        # IBMQ backends accept at most 900 experiments per job. If set, lists of circuits are
+        # split over several jobs of at most this many circuits, and lists of jobs are returned
+        self.max_circuits_per_job = max_circuits_per_job
+
         self.aer_backend = Aer.get_backend("qasm_simulator")
         self.physical_backend = None
 
@@ -42,14 +49,47 @@ class IBMQHandler:
         self.physical_backend = self.provider.get_backend(backend_name)
         print(self.physical_backend.name())
 
-    def simulate_quantum_circuit(self, circuit: QuantumCircuit, noise_model: NoiseModel = None) -> dict:
-        if noise_model == None:
-            return execute(circuit, backend=self.aer_backend, shots=self.shots)
+    def simulate_quantum_circuit(self, circuit: Union[QuantumCircuit, list], noise_model: NoiseModel = None):
+        if noise_model is None:
+            return self._execute(circuit, backend=self.aer_backend)
         else:
-            return execute(circuit, backend=self.aer_backend, noise_model=noise_model, shots=self.shots)
+            return self._execute(circuit, backend=self.aer_backend, noise_model=noise_model)
+
+    def run_quantum_circuit_on_IBMQ(self, circuit: Union[QuantumCircuit, list]):
+        return self._execute(circuit, backend=self.physical_backend)
 
-    def run_quantum_circuit_on_IBMQ(self, circuit: QuantumCircuit) -> dict:
-        return execute(circuit, backend=self.physical_backend, shots=self.shots)
+    # A circuit, or a list of circuits, is submitted as a single job and that job is returned.
+    # If max_circuits_per_job is set, a list of circuits is instead always split into chunks of
+    # at most that many circuits, and the list of jobs is returned. Use get_counts to collect
+    # the counts in either case.
+
+    def _execute(self, circuit: Union[QuantumCircuit, list], **kwargs):
+        if self.max_circuits_per_job is None or isinstance(circuit, QuantumCircuit):
+            return execute(circuit, shots=self.shots, **kwargs)
+
+        return [execute(circuit[i:i + self.max_circuits_per_job], shots=self.shots, **kwargs)
+                for i in range(0, len(circuit), self.max_circuits_per_job)]
 
     def retrieve_job(self, job_id: str):
         return self.physical_backend.retrieve_job(job_id=job_id)
+
+
+# Utility functions:
+
+# Collects the measurement result counts from a job, or a list of jobs, as returned by
+# IBMQHandler.simulate_quantum_circuit and IBMQHandler.run_quantum_circuit_on_IBMQ.
+# Counts are returned in the same order as the submitted circuits.
+
+def get_counts(jobs) -> list:
+    if not isinstance(jobs, list):
+        jobs = [jobs]
+
+    counts = []
+    for job in jobs:
+        job_counts = job.result().get_counts()
+        if isinstance(job_counts, dict):
+            counts.append(job_counts)
+        else:
+            counts.extend(job_counts)
+
+    return counts
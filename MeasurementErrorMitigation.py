@@ -1,12 +1,17 @@
+from functools import lru_cache
+
 from qiskit import (
     IBMQ, QuantumCircuit
 )
 from numpy import (
-    ndarray, asarray, zeros, empty,
-    sum, dot
+    ndarray, asarray, zeros, empty, fromiter, flatnonzero, array,
+    stack, concatenate, full, sum, abs, isfinite, maximum, tensordot, moveaxis,
+    int64, float32, float64
 )
 
-from scipy.linalg import inv
+from scipy.linalg import get_lapack_funcs
+from scipy.sparse import coo_matrix
+from scipy.sparse.linalg import splu
 
 #
 # This class handles linear error mitigation for measurement errors on quantum computers.
@@ -17,55 +22,320 @@ from scipy.linalg import inv
 
 class MeasurementErrorMitigation:
 
-    def __init__(self, n_qubits: int):
+    def __init__(self, n_qubits: int, dtype=None):
 
         self.n_qubits = n_qubits
-        self.error_mitigation_matrix = empty(0)
-
-    def build_mitigation_circuit(self):
-        circuits = []
-        for i in range(2 ** self.n_qubits):
 
-            circuits.append(QuantumCircuit(5))
+        # Floating point type of the calibration matrix and count vectors. Counts are integers
+        # bounded by the number of shots, exact in float32 up to 2**24 shots, and the shot noise
+        # is far above float32 precision. Single precision halves the memory traffic of every
+        # solve, so it is the default up to 20 qubits, where conditioning is still unproblematic.
+        # A calibration with more than 2**24 shots promotes float32 to float64. Counts passed to
+        # prepare or the mitigation methods are converted to dtype as they are, so results with
+        # more than 2**24 shots need dtype=float64
+        if dtype is None:
+            dtype = float32 if n_qubits <= 20 else float64
+        self.dtype = dtype
+
+        self.calibration_matrix = empty(0)
+
+        # LU factorization of the calibration matrix, computed once and reused by every mitigation.
+        # Either dense (LAPACK getrf) or, if the matrix was built with a tolerance, sparse (splu).
+        # The dense factors are solved against by calling LAPACK getrs directly, which skips
+        # the input validation of the scipy.linalg wrappers on every mitigation
+        self.lu_factors = None
+        self.sparse = False
+        self._getrs = None
+
+        # Infinity norm of E = I - calibration_matrix, deciding whether the Neumann series converges
+        self._error_norm = None
+
+        # Inverted 2x2 calibration matrices of each qubit, used by the tensored mitigation
+        # which assumes the readout errors of the qubits are independent
+        self.factors = []
 
-            bit_string = '{0:0{1}b}'.format(i, self.n_qubits)
+    def build_mitigation_circuit(self):
+        circuits = [None] * 2 ** self.n_qubits
+        circuits[0] = QuantumCircuit(self.n_qubits)
 
-            for k in range(self.n_qubits):
-                if bit_string[self.n_qubits - k - 1] == '1':
-                    circuits[i].x(k)
+        # circuits[i] prepares the basis state i, qubit k being bit k of i. Each circuit is a copy
+        # of the one for i with its lowest set bit cleared, plus a single x gate on that qubit,
+        # so only 2**n_qubits - 1 gates are appended in total.
+        for i in range(1, 2 ** self.n_qubits):
+            circuits[i] = circuits[i & (i - 1)].copy()
+            circuits[i].x((i & -i).bit_length() - 1)
 
-            circuits[i].measure_all()
+        for circuit in circuits:
+            circuit.measure_all()
 
         return circuits
 
-    def build_error_mitigation_matrix(self, measurement_results: list):
-        matrix = zeros((2 ** self.n_qubits, 2 ** self.n_qubits))
+    # With a tolerance tol, entries of the calibration matrix smaller than tol are dropped and the
+    # matrix is stored and factorized as a sparse matrix. Realistic readout errors are small, so
+    # the matrix is strongly diagonally dominant and few entries remain.
+    # If the number of shots every calibration circuit was run with is given, the counts are
+    # normalized by it directly instead of by their sums.
 
-        for i in range(2 ** self.n_qubits):
-            vec = build_vector(measurement_results[i], self.n_qubits)
-            num_shots = sum(vec)
+    def build_error_mitigation_matrix(self, measurement_results: list, tol: float = None, shots: int = None):
+        # a failed build must not leave the previous calibration in place
+        self._clear_calibration()
 
-            for k in range(2 ** self.n_qubits):
-                matrix[i][k] = vec[k] / num_shots
+        # float32 holds integer counts exactly only up to 2**24
+        if self.dtype == float32:
+            max_shots = max((sum(list(results.values())) for results in measurement_results), default=0)
+            if max(max_shots, shots or 0) > 2 ** 24:
+                self.dtype = float64
 
-        self.error_mitigation_matrix = inv(matrix)
+        if tol is None:
+            self._build_dense_matrix(measurement_results, shots)
+        else:
+            self._build_sparse_matrix(measurement_results, tol, shots)
+
+        if self.lu_factors is None:
+            return
+
+        # row sums of |I - M|, i.e. the off diagonal row sums of M plus |1 - M_ii|, M being non-negative
+        diagonal = self.calibration_matrix.diagonal()
+        row_sums = asarray(self.calibration_matrix.sum(axis=1)).ravel()
+        self._error_norm = (row_sums - diagonal + abs(1 - diagonal)).max()
+
+    def _build_dense_matrix(self, measurement_results: list, shots: int = None):
+        # row i holds the counts measured when preparing basis state i, normalized to probabilities.
+        # Transposed, matrix[k][i] is the probability of measuring k given i was prepared,
+        # so that measured counts = matrix . ideal counts
+        matrix = stack([build_vector(measurement_results[i], self.n_qubits, self.dtype)
+                        for i in range(2 ** self.n_qubits)])
+
+        # LAPACK getrf does not check its input, a NaN pivot is accepted as nonzero
+        row_sums = sum(matrix, axis=1, keepdims=True)
+        if (row_sums == 0).any():
+            print("No calibration counts for basis state", flatnonzero(row_sums == 0)[0])
+            return
+
+        if shots is None:
+            matrix /= row_sums
+        else:
+            matrix /= shots
+        matrix = matrix.T
+
+        if not isfinite(matrix).all():
+            print("Calibration matrix is not finite")
+            return
+
+        getrf, self._getrs = get_lapack_funcs(('getrf', 'getrs'), (matrix,))
+        lu, piv, info = getrf(matrix)
+        if info > 0:
+            print("Calibration matrix is singular")
+            return
+        elif info < 0:
+            print("Invalid argument", -info, "to LAPACK getrf")
+            return
+
+        self.calibration_matrix = matrix
+        self.lu_factors = (lu, piv)
+        self.sparse = False
+
+    # Builds the same matrix as above directly in sparse form from the observed counts,
+    # so the dense 2**n_qubits x 2**n_qubits matrix is never allocated.
+
+    def _build_sparse_matrix(self, measurement_results: list, tol: float, shots: int = None):
+        rows, columns, data = [], [], []
+        for i in range(2 ** self.n_qubits):
+            idx, counts = parse_counts(measurement_results[i], self.n_qubits, self.dtype)
+            if sum(counts) == 0:
+                print("No calibration counts for basis state", i)
+                return
+
+            if shots is None:
+                counts /= sum(counts)
+            else:
+                counts /= shots
+
+            kept = counts >= tol
+            rows.append(idx[kept])
+            columns.append(full(kept.sum(), i))
+            data.append(counts[kept])
+
+        dim = 2 ** self.n_qubits
+        sparse_matrix = coo_matrix((concatenate(data), (concatenate(rows), concatenate(columns))),
+                                   shape=(dim, dim)).tocsc()
+        try:
+            lu_factors = splu(sparse_matrix)
+        except RuntimeError:
+            print("Calibration matrix is singular")
+            return
+
+        self.calibration_matrix = sparse_matrix
+        self.lu_factors = lu_factors
+        self.sparse = True
+
+    def _clear_calibration(self):
+        self.calibration_matrix = empty(0)
+        self.lu_factors = None
+        self.sparse = False
+        self._getrs = None
+        self._error_norm = None
+
+    # Converts measurement result counts to the dense vector form once. When the same counts are
+    # mitigated several times, passing the prepared vector to mitigate_errors skips the dict
+    # conversion, leaving only the solve against the already factorized calibration matrix.
+
+    def prepare(self, counts: dict) -> ndarray:
+        return build_vector(counts, self.n_qubits, self.dtype)
 
     def mitigate_errors(self, measurement_results: list or dict or ndarray) -> dict:
-        if self.error_mitigation_matrix.shape[0] == 0:
+        if self.lu_factors is None:
             print("Error mitigation matrix not built")
             return {}
 
-        if type(measurement_results) == dict:
-            vec = build_vector(measurement_results, self.n_qubits)
-        elif type(measurement_results) == list:
-            vec = asarray(measurement_results)
-        elif type(measurement_results) == ndarray:
-            vec = measurement_results
+        vec = self._input_vector(measurement_results)
+        if vec is None:
+            return {}
+
+        if self.sparse:
+            return build_dict(self.lu_factors.solve(vec), self.n_qubits)
+
+        lu, piv = self.lu_factors
+        x, info = self._getrs(lu, piv, vec, overwrite_b=isinstance(measurement_results, dict))
+
+        return build_dict(x, self.n_qubits)
+
+    # Mitigates a list of measurement result counts at once. The count vectors are stacked as the
+    # columns of one matrix and solved in a single LAPACK call with many right hand sides,
+    # instead of one call per vector.
+
+    def mitigate_errors_batch(self, measurement_results: list) -> list:
+        if self.lu_factors is None:
+            print("Error mitigation matrix not built")
+            return []
+
+        if len(measurement_results) == 0:
+            return []
+
+        vecs = [self._input_vector(results) for results in measurement_results]
+        if any(vec is None for vec in vecs):
+            return []
+
+        # (2**n_qubits, len(measurement_results)), Fortran ordered as LAPACK expects
+        vecs = stack(vecs).T
+
+        if self.sparse:
+            x = self.lu_factors.solve(vecs)
         else:
-            print("Invalid argument type", type(measurement_results))
+            lu, piv = self.lu_factors
+            x, info = self._getrs(lu, piv, vecs, overwrite_b=True)
+
+        return [build_dict(x[:, i], self.n_qubits) for i in range(x.shape[1])]
+
+    # Readout calibration matrices are close to the identity, M = I - E with ||E|| << 1, so the
+    # inverse can be approximated by the truncated Neumann series M^-1 v = v + E v + E^2 v + ...
+    # Terms are added until one changes no count by more than count_tol, at most max_order of them.
+    # For ||E|| <= 0.5 the remaining tail is then no larger than the last term.
+    # E w is computed as w - M w, so only matrix-vector products with M are needed.
+    # The exact solve is used instead if ||E|| > 0.5, where the series converges too slowly,
+    # or if the series has not converged to count_tol within max_order terms.
+
+    def mitigate_errors_neumann(self, measurement_results: list or dict or ndarray,
+                                max_order: int = 2, count_tol: float = 0.5) -> dict:
+        if self.lu_factors is None:
+            print("Error mitigation matrix not built")
             return {}
 
-        return build_dict(dot(self.error_mitigation_matrix, vec), self.n_qubits)
+        vec = self._input_vector(measurement_results)
+        if vec is None:
+            return {}
+
+        if self._error_norm > 0.5:
+            return self.mitigate_errors(vec)
+
+        result = vec.copy()
+        term = vec
+        for _ in range(max_order):
+            term = term - self.calibration_matrix @ term
+            result += term
+
+            if abs(term).max() < count_tol:
+                return build_dict(result, self.n_qubits)
+
+        return self.mitigate_errors(vec)
+
+    # Under the assumption of independent readout errors, the full calibration matrix is the
+    # tensor product A_{n-1} x ... x A_0 of one 2x2 matrix per qubit. These are fitted from only
+    # two circuits, preparing |00...0> and |11...1>, instead of all 2**n_qubits basis states.
+
+    def build_tensored_mitigation_circuit(self):
+        circuits = [QuantumCircuit(self.n_qubits), QuantumCircuit(self.n_qubits)]
+
+        circuits[1].x(range(self.n_qubits))
+
+        for circuit in circuits:
+            circuit.measure_all()
+
+        return circuits
+
+    def build_tensored_mitigation_matrices(self, measurement_results: list):
+        self.factors = []
+
+        if len(measurement_results) < 2:
+            print("Results of both tensored mitigation circuits are needed")
+            return
+
+        for k in range(self.n_qubits):
+            # A[measured][prepared] for qubit k, marginalized over all other qubits
+            A = zeros((2, 2))
+            for prepared in range(2):
+                for bit_string, count in measurement_results[prepared].items():
+                    A[int(bit_string[self.n_qubits - k - 1])][prepared] += count
+
+            column_sums = sum(A, axis=0)
+            if (column_sums == 0).any():
+                print("No calibration counts for qubit", k)
+                self.factors = []
+                return
+
+            A /= column_sums
+
+            (a, b), (c, d) = A
+            if a * d - b * c == 0:
+                print("Calibration matrix of qubit", k, "is singular")
+                self.factors = []
+                return
+
+            self.factors.append((array([[d, -b], [-c, a]]) / (a * d - b * c)).astype(self.dtype))
+
+    def mitigate_errors_tensored(self, measurement_results: list or dict or ndarray) -> dict:
+        if len(self.factors) == 0:
+            print("Tensored error mitigation matrices not built")
+            return {}
+
+        vec = self._input_vector(measurement_results)
+        if vec is None:
+            return {}
+
+        # axis j of the reshaped vector is the bit at position j of the bitstring, i.e. qubit n-1-j
+        x = vec.reshape([2] * self.n_qubits)
+        for k in range(self.n_qubits):
+            axis = self.n_qubits - k - 1
+            x = moveaxis(tensordot(self.factors[k], x, axes=([1], [axis])), 0, axis)
+
+        return build_dict(x.ravel(), self.n_qubits)
+
+    # Counts given as an ndarray of the dtype are used as they are, without copying.
+    # A dict is converted to a new vector, which the solver is then free to overwrite.
+
+    def _input_vector(self, measurement_results: list or dict or ndarray) -> ndarray:
+        if isinstance(measurement_results, dict):
+            return build_vector(measurement_results, self.n_qubits, self.dtype)
+        elif isinstance(measurement_results, (list, ndarray)):
+            vec = asarray(measurement_results, dtype=self.dtype)
+            if vec.shape != (2 ** self.n_qubits,):
+                print("Invalid argument shape", vec.shape)
+                return None
+
+            return vec
+        else:
+            print("Invalid argument type", type(measurement_results))
+            return None
 
 # Utility functions:
 
@@ -76,28 +346,47 @@ class MeasurementErrorMitigation:
 # This function builds a numpy array on the form
 # vec = numpy.ndarray( [ 7000, 534, 0, 12, .... , 35 ] )
 
-def build_vector(measurement_results: dict, n_qubits: int) -> ndarray:
-    vec = zeros(2 ** n_qubits)
-
-    for i in range(2 ** n_qubits):
-        bit_string = '{0:0{1}b}'.format(i, n_qubits)    # every n-bit bitstring
+def build_vector(measurement_results: dict, n_qubits: int, dtype=float64) -> ndarray:
+    vec = zeros(2 ** n_qubits, dtype)
 
-        if bit_string in measurement_results.keys():
-            vec[i] = measurement_results[bit_string]
+    idx, counts = parse_counts(measurement_results, n_qubits, dtype)
+    vec[idx] = counts
 
     return vec
 
 
-# This function takes a numpy array on the form outputted from the function above,
+# This function parses only the observed bitstrings of the measurement result counts, returning
+# the indices of the bitstrings and their counts as two numpy arrays
+
+def parse_counts(measurement_results: dict, n_qubits: int, dtype=float64) -> tuple:
+    idx = fromiter((int(bit_string, 2) for bit_string in measurement_results),
+                   dtype=int64, count=len(measurement_results))
+    counts = fromiter(measurement_results.values(), dtype=dtype, count=len(measurement_results))
+
+    # bitstrings longer than n_qubits do not fit in a count vector
+    if idx.size and idx.max() >= 2 ** n_qubits:
+        raise IndexError("bitstring {0} does not fit in {1} qubits".format(
+            '{0:b}'.format(idx.max()), n_qubits))
+
+    return idx, counts
+
+
+# This function takes a numpy array on the form outputted by build_vector,
 # and builds a dictionary on the same form as qiskit outputs the measurement results counts in
 
 def build_dict(vec: ndarray, n_qubits: int) -> dict:
-    dic = {}
+    # only the nonzero entries are formatted, negative counts are clipped to 0 and dropped
+    idx = flatnonzero(vec)
+    counts = maximum(vec[idx].astype(int64), 0)
+
+    bit_strings = _bitstrings(n_qubits)
+
+    return {bit_strings[i]: count for i, count in zip(idx.tolist(), counts.tolist()) if count}
 
-    for i in range(2 ** n_qubits):
-        if vec[i] != 0:
-            bit_string = '{0:0{1}b}'.format(i, n_qubits)    # every n-bit bitstring
 
-            dic[bit_string] = max(int(vec[i]), 0)
+# Table of every n-bit bitstring, _bitstrings(n)[i] being the bitstring of index i.
+# Built once per number of qubits and shared by all subsequent calls.
 
-    return dic
+@lru_cache(maxsize=None)
+def _bitstrings(n_qubits: int) -> tuple:
+    return tuple('{0:0{1}b}'.format(i, n_qubits) for i in range(2 ** n_qubits))